@@ -3,12 +3,19 @@ Black-box tests of the DjangoUserStateClient against the semantics
 defined in edx_user_state_client.
 """
 
+import json
 from collections import defaultdict
 from unittest import skip
 
+from mock import ANY, patch
+
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils.timezone import now
 
 from edx_user_state_client.tests import UserStateClientTestBase
+from courseware.models import StudentModule
 from courseware.user_state_client import DjangoXBlockUserStateClient
 from courseware.tests.factories import UserFactory
 
@@ -29,6 +36,12 @@ class TestDjangoUserStateClient(UserStateClientTestBase, TestCase):
         # when the block type is 'problem'
         return 'problem'
 
+    def _html_block(self, block):
+        """
+        Return a UsageKey for the block ``block``, with a type that doesn't record history.
+        """
+        return self._block(block).replace(block_type='html')
+
     def setUp(self):
         super(TestDjangoUserStateClient, self).setUp()
         self.client = DjangoXBlockUserStateClient()
@@ -67,3 +80,102 @@ class TestDjangoUserStateClient(UserStateClientTestBase, TestCase):
     @skip("Not supported by DjangoXBlockUserStateClient")
     def test_iter_course_many_users(self):
         pass
+
+    def test_get_history_query_count(self):
+        # Loading the history shouldn't query for the StudentModule of each history entry.
+        self.set(user=0, block=0, state={'a': 0})
+        with CaptureQueriesContext(connection) as single_entry_queries:
+            self.assertEquals(len(list(self.get_history(user=0, block=0))), 1)
+
+        for val in xrange(1, 4):
+            self.set(user=0, block=0, state={'a': val})
+        with CaptureQueriesContext(connection) as many_entry_queries:
+            self.assertEquals(len(list(self.get_history(user=0, block=0))), 4)
+
+        self.assertEquals(len(single_entry_queries), len(many_entry_queries))
+
+    def test_set_many_row_created_concurrently(self):
+        # Simulate another request creating the row after set_many has loaded the existing rows.
+        self.set(user=0, block=0, state={'a': 'x', 'b': 'y'})
+        with patch.object(self.client, '_get_student_modules', return_value=iter([])):
+            with patch.object(self.client, '_ddog_increment') as mock_increment:
+                self.set_many(user=0, block_to_state={0: {'a': 'z'}})
+
+        self.assertEquals(StudentModule.objects.count(), 1)
+        self.assertEquals(self.get(user=0, block=0).state, {'a': 'z', 'b': 'y'})
+        mock_increment.assert_called_once_with(ANY, 'set_many.state_updated', 1)
+
+    def test_set_many_bulk_creates_non_history_blocks(self):
+        username = self._user(0)
+        block_keys_to_state = {self._html_block(block): {'a': block} for block in xrange(3)}
+        # Database datetimes may be stored without microseconds.
+        before = now().replace(microsecond=0)
+
+        # Load the user, load the existing rows, then SAVEPOINT, INSERT, RELEASE
+        # for a single bulk insert of all of the rows. No history is written.
+        with patch('dogstats_wrapper.increment') as mock_increment:
+            with self.assertNumQueries(5, using='default'):
+                with self.assertNumQueries(0, using='student_module_history'):
+                    self.client.set_many(username, block_keys_to_state)
+
+        after = now()
+
+        # bulk_create doesn't send post_save, so the rows are counted in the same
+        # edxapp.db.model metric as post_save_metrics would have, in a single increment.
+        created_calls = [
+            (args, kwargs)
+            for args, kwargs in mock_increment.call_args_list
+            if args == ('edxapp.db.model',) and u'action:created' in kwargs['tags']
+        ]
+        self.assertEquals(len(created_calls), 1)
+        _, kwargs = created_calls[0]
+        self.assertEquals(kwargs['value'], 3)
+        self.assertItemsEqual(kwargs['tags'], [
+            u'instance.course_id:{}'.format(self._course(0)),
+            u'instance.module_type:html',
+            u'model_class:StudentModule',
+            u'action:created',
+            u'database:default',
+        ])
+
+        for block_key, state in block_keys_to_state.items():
+            student_module = StudentModule.objects.get(
+                student__username=username,
+                course_id=block_key.course_key,
+                module_state_key=block_key,
+            )
+            self.assertEquals(student_module.module_type, 'html')
+            self.assertEquals(json.loads(student_module.state), state)
+            self.assertTrue(before <= student_module.created <= after)
+            self.assertTrue(before <= student_module.modified <= after)
+
+    def test_set_many_bulk_create_conflict(self):
+        username = self._user(0)
+        existing_key, new_key = self._html_block(0), self._html_block(1)
+        StudentModule.objects.create(
+            student=self.users[0],
+            course_id=existing_key.course_key,
+            module_state_key=existing_key,
+            module_type='html',
+            state=json.dumps({'a': 'x', 'b': 'y'}),
+        )
+
+        # Simulate another request creating one of the rows after set_many has
+        # loaded the existing rows, so that the bulk insert fails.
+        with patch.object(self.client, '_get_student_modules', return_value=iter([])):
+            with patch.object(self.client, '_ddog_increment') as mock_increment:
+                with patch('courseware.user_state_client.bulk_create_metrics') as mock_bulk_create_metrics:
+                    self.client.set_many(username, {existing_key: {'a': 'z'}, new_key: {'a': 'w'}})
+
+        self.assertEquals(StudentModule.objects.count(), 2)
+        states = {
+            block_state.block_key: block_state.state
+            for block_state in self.client.get_many(username, [existing_key, new_key])
+        }
+        self.assertEquals(states, {existing_key: {'a': 'z', 'b': 'y'}, new_key: {'a': 'w'}})
+        mock_increment.assert_any_call(ANY, 'set_many.state_created', 1)
+        mock_increment.assert_any_call(ANY, 'set_many.state_updated', 1)
+        self.assertEquals(mock_increment.call_count, 2)
+        # The rolled-back bulk insert isn't counted; the rows created one at a
+        # time are counted by post_save_metrics instead.
+        self.assertFalse(mock_bulk_create_metrics.called)
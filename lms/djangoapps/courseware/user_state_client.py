@@ -3,8 +3,7 @@ An implementation of :class:`XBlockUserStateClient`, which stores XBlock Scope.u
 data in a Django ORM model.
 """
 
-import itertools
-from operator import attrgetter
+from collections import defaultdict
 from time import time
 import logging
 try:
@@ -17,12 +16,20 @@ from django.contrib.auth.models import User
 from django.db import transaction
 from django.db.utils import IntegrityError
 from xblock.fields import Scope
-from courseware.models import StudentModule, BaseStudentModuleHistory
+from courseware.models import StudentModule, BaseStudentModuleHistory, chunks
 from edx_user_state_client.interface import XBlockUserStateClient, XBlockUserState
+from openedx.core.djangoapps.monitoring.signals import bulk_create_metrics
 
 log = logging.getLogger(__name__)
 
 
+def _serialize_state(state):
+    """
+    Serialize a state dict for storage in :attr:`StudentModule.state`, without whitespace.
+    """
+    return json.dumps(state, separators=(',', ':'))
+
+
 class DjangoXBlockUserStateClient(XBlockUserStateClient):
     """
     An interface that uses the Django ORM StudentModule as a backend.
@@ -46,6 +53,9 @@ class DjangoXBlockUserStateClient(XBlockUserStateClient):
     # Use this sample rate for DataDog events.
     API_DATADOG_SAMPLE_RATE = 0.1
 
+    # The number of block keys to put in a single ``module_state_key IN (...)`` query.
+    CHUNK_SIZE = 500
+
     class ServiceUnavailable(XBlockUserStateClient.ServiceUnavailable):
         """
         This error is raised if the service backing this client is currently unavailable.
@@ -72,6 +82,8 @@ class DjangoXBlockUserStateClient(XBlockUserStateClient):
                 the user state.
         """
         self.user = user
+        # Users loaded by `set_many`, keyed by username.
+        self._user_cache = {}
 
     def _get_student_modules(self, username, block_keys):
         """
@@ -81,30 +93,30 @@ class DjangoXBlockUserStateClient(XBlockUserStateClient):
             username (str): The name of the user to load `StudentModule`s for.
             block_keys (list of :class:`~UsageKey`): The set of XBlocks to load data for.
         """
-        course_key_func = attrgetter('course_key')
-        by_course = itertools.groupby(
-            sorted(block_keys, key=course_key_func),
-            course_key_func,
-        )
-
-        for course_key, usage_keys in by_course:
-            query = StudentModule.objects.chunked_filter(
-                'module_state_key__in',
-                usage_keys,
-                student__username=username,
-                course_id=course_key,
-            )
-
-            for student_module in query:
-                usage_key = student_module.module_state_key.map_into_course(student_module.course_id)
-                yield (student_module, usage_key)
-
-    def _ddog_increment(self, evt_time, evt_name):
+        by_course = defaultdict(list)
+        for block_key in block_keys:
+            by_course[block_key.course_key].append(block_key)
+
+        for course_key, usage_keys in by_course.iteritems():
+            for chunk in chunks(usage_keys, self.CHUNK_SIZE):
+                # Use iterator() so that the rows aren't also kept in the queryset's cache.
+                query = StudentModule.objects.filter(
+                    student__username=username,
+                    course_id=course_key,
+                    module_state_key__in=chunk,
+                ).iterator()
+
+                for student_module in query:
+                    usage_key = student_module.module_state_key.map_into_course(student_module.course_id)
+                    yield (student_module, usage_key)
+
+    def _ddog_increment(self, evt_time, evt_name, value=1):
         """
         DataDog increment method.
         """
         dog_stats_api.increment(
             'DjangoXBlockUserStateClient.{}'.format(evt_name),
+            value=value,
             timestamp=evt_time,
             sample_rate=self.API_DATADOG_SAMPLE_RATE,
         )
@@ -120,6 +132,13 @@ class DjangoXBlockUserStateClient(XBlockUserStateClient):
             sample_rate=self.API_DATADOG_SAMPLE_RATE,
         )
 
+    def _ddog_increment_many(self, evt_time, evt_counts):
+        """
+        Submit one DataDog increment per event name in ``evt_counts``, rather than one per block.
+        """
+        for evt_name, count in evt_counts.iteritems():
+            self._ddog_increment(evt_time, evt_name, count)
+
     def get_many(self, username, block_keys, scope=Scope.user_state, fields=None):
         """
         Retrieve the stored XBlock state for the specified XBlock usages.
@@ -137,7 +156,8 @@ class DjangoXBlockUserStateClient(XBlockUserStateClient):
         if scope != Scope.user_state:
             raise ValueError("Only Scope.user_state is supported, not {}".format(scope))
 
-        block_count = state_length = 0
+        block_count = 0
+        evt_counts = defaultdict(int)
         evt_time = time()
 
         self._ddog_histogram(evt_time, 'get_many.blks_requested', len(block_keys))
@@ -145,12 +165,10 @@ class DjangoXBlockUserStateClient(XBlockUserStateClient):
         modules = self._get_student_modules(username, block_keys)
         for module, usage_key in modules:
             if module.state is None:
-                self._ddog_increment(evt_time, 'get_many.empty_state')
+                evt_counts['get_many.empty_state'] += 1
                 continue
 
             state = json.loads(module.state)
-            state_length += len(module.state)
-
             self._ddog_histogram(evt_time, 'get_many.block_size', len(module.state))
 
             # If the state is the empty dict, then it has been deleted, and so
@@ -170,6 +188,7 @@ class DjangoXBlockUserStateClient(XBlockUserStateClient):
         # The rest of this method exists only to submit DataDog events.
         # Remove it once we're no longer interested in the data.
         finish_time = time()
+        self._ddog_increment_many(evt_time, evt_counts)
         self._ddog_histogram(evt_time, 'get_many.blks_out', block_count)
         self._ddog_histogram(evt_time, 'get_many.response_time', (finish_time - evt_time) * 1000)
 
@@ -188,32 +207,102 @@ class DjangoXBlockUserStateClient(XBlockUserStateClient):
         if scope != Scope.user_state:
             raise ValueError("Only Scope.user_state is supported")
 
-        # We do a find_or_create for every block (rather than re-using field objects
-        # that were queried in get_many) so that if the score has
-        # been changed by some other piece of the code, we don't overwrite
-        # that score.
         if self.user is not None and self.user.username == username:
             user = self.user
         else:
-            user = User.objects.get(username=username)
+            user = self._user_cache.get(username)
+            if user is None:
+                user = User.objects.get(username=username)
+                self._user_cache[username] = user
 
         if user.is_anonymous():
             # Anonymous users cannot be persisted to the database, so let's just use
             # what we have.
             return
 
+        evt_counts = defaultdict(int)
         evt_time = time()
 
+        # We re-read the existing rows (rather than re-using field objects
+        # that were queried in get_many) so that if the score has
+        # been changed by some other piece of the code, we don't overwrite
+        # that score. All of the rows are loaded in a single chunked query,
+        # rather than with a get_or_create for every block.
+        #
+        # The rows are keyed by their block keys mapped into the course (see
+        # `_get_student_modules`), so this assumes callers pass mapped keys, like the
+        # ones `get_many` returns. A block whose key isn't mapped (e.g. has run=None)
+        # won't be found here, and will fall back to the slower IntegrityError path below.
+        existing_modules = {
+            usage_key: student_module
+            for student_module, usage_key
+            in self._get_student_modules(username, block_keys_to_state.keys())
+        }
+
+        # New rows for block types whose history isn't recorded can all be inserted
+        # at once, since bulk_create doesn't send post_save. New rows that do need
+        # history are created individually below.
+        #
+        # StudentModule has these post_save receivers, and skipping them is only safe
+        # while each one is handled here:
+        #   * `StudentModuleHistory.save_history` (courseware/models.py) and
+        #     `StudentModuleHistoryExtended.save_history` (coursewarehistoryextended/models.py)
+        #     ignore block types outside HISTORY_SAVING_TYPES, which are filtered out below.
+        #   * `post_save_metrics` (openedx/core/djangoapps/monitoring/signals.py) counts
+        #     every created row, so the same metric is sent for the bulk-created rows
+        #     with `bulk_create_metrics`.
+        # Any other post_save receiver added for StudentModule won't see these rows.
+        new_keys = [
+            usage_key
+            for usage_key in block_keys_to_state
+            if usage_key not in existing_modules
+            and usage_key.block_type not in BaseStudentModuleHistory.HISTORY_SAVING_TYPES
+        ]
+        bulk_created_keys = set()
+        if new_keys:
+            new_modules = [
+                StudentModule(
+                    student=user,
+                    course_id=usage_key.course_key,
+                    module_state_key=usage_key,
+                    state=_serialize_state(block_keys_to_state[usage_key]),
+                    module_type=usage_key.block_type,
+                )
+                for usage_key in new_keys
+            ]
+            try:
+                with transaction.atomic():
+                    StudentModule.objects.bulk_create(new_modules, batch_size=self.CHUNK_SIZE)
+            except IntegrityError:
+                # Some of the rows were created after the existing rows were loaded,
+                # so fall back to creating the rows one at a time below.
+                pass
+            else:
+                bulk_created_keys = set(new_keys)
+                bulk_create_metrics(new_modules, StudentModule.objects.db)
+
         for usage_key, state in block_keys_to_state.items():
-            student_module, created = StudentModule.objects.get_or_create(
-                student=user,
-                course_id=usage_key.course_key,
-                module_state_key=usage_key,
-                defaults={
-                    'state': json.dumps(state),
-                    'module_type': usage_key.block_type,
-                },
-            )
+            student_module = existing_modules.get(usage_key)
+            created = student_module is None
+            if created and usage_key not in bulk_created_keys:
+                try:
+                    with transaction.atomic():
+                        student_module = StudentModule.objects.create(
+                            student=user,
+                            course_id=usage_key.course_key,
+                            module_state_key=usage_key,
+                            state=_serialize_state(state),
+                            module_type=usage_key.block_type,
+                        )
+                except IntegrityError:
+                    # The row was created after the existing rows were loaded,
+                    # so update it instead.
+                    student_module = StudentModule.objects.get(
+                        student=user,
+                        course_id=usage_key.course_key,
+                        module_state_key=usage_key,
+                    )
+                    created = False
 
             num_fields_before = num_fields_after = num_new_fields_set = len(state)
             num_fields_updated = 0
@@ -225,7 +314,7 @@ class DjangoXBlockUserStateClient(XBlockUserStateClient):
                 num_fields_before = len(current_state)
                 current_state.update(state)
                 num_fields_after = len(current_state)
-                student_module.state = json.dumps(current_state)
+                student_module.state = _serialize_state(current_state)
                 try:
                     with transaction.atomic():
                         # Updating the object - force_update guarantees no INSERT will occur.
@@ -245,9 +334,9 @@ class DjangoXBlockUserStateClient(XBlockUserStateClient):
             #
             # Record whether a state row has been created or updated.
             if created:
-                self._ddog_increment(evt_time, 'set_many.state_created')
+                evt_counts['set_many.state_created'] += 1
             else:
-                self._ddog_increment(evt_time, 'set_many.state_updated')
+                evt_counts['set_many.state_updated'] += 1
 
             # Event to record number of fields sent in to set/set_many.
             self._ddog_histogram(evt_time, 'set_many.fields_in', len(state))
@@ -262,6 +351,7 @@ class DjangoXBlockUserStateClient(XBlockUserStateClient):
 
         # Events for the entire set_many call.
         finish_time = time()
+        self._ddog_increment_many(evt_time, evt_counts)
         self._ddog_histogram(evt_time, 'set_many.blks_updated', len(block_keys_to_state))
         self._ddog_histogram(evt_time, 'set_many.response_time', (finish_time - evt_time) * 1000)
 
@@ -286,6 +376,10 @@ class DjangoXBlockUserStateClient(XBlockUserStateClient):
 
         self._ddog_histogram(evt_time, 'delete_many.block_count', len(block_keys))
 
+        # Each row is saved individually (rather than with a single bulk UPDATE) so
+        # that the post_save receivers, including the history writers, run for it.
+        # The saves also aren't wrapped in a transaction: with ENABLE_CSMH_EXTENDED,
+        # history is written to a separate database, which a rollback here wouldn't undo.
         student_modules = self._get_student_modules(username, block_keys)
         for student_module, _ in student_modules:
             if fields is None:
@@ -296,7 +390,7 @@ class DjangoXBlockUserStateClient(XBlockUserStateClient):
                     if field in current_state:
                         del current_state[field]
 
-                student_module.state = json.dumps(current_state)
+                student_module.state = _serialize_state(current_state)
 
             # We just read this object, so we know that we can do an update
             student_module.save(force_update=True)
@@ -324,13 +418,13 @@ class DjangoXBlockUserStateClient(XBlockUserStateClient):
 
         if scope != Scope.user_state:
             raise ValueError("Only Scope.user_state is supported")
-        student_modules = list(
-            student_module
-            for student_module, usage_id
-            in self._get_student_modules(username, [block_key])
-        )
-        if len(student_modules) == 0:
+        modules = self._get_student_modules(username, [block_key])
+        first_module = next(modules, None)
+        if first_module is None:
             raise self.DoesNotExist()
+        modules_and_keys = [first_module]
+        modules_and_keys.extend(modules)
+        student_modules = [student_module for student_module, _ in modules_and_keys]
 
         history_entries = BaseStudentModuleHistory.get_history(student_modules)
 
@@ -338,6 +432,14 @@ class DjangoXBlockUserStateClient(XBlockUserStateClient):
         if not history_entries:
             raise self.DoesNotExist()
 
+        # Every history entry belongs to one of the modules loaded above, so look up
+        # its (already course-mapped) block key here rather than querying for its
+        # StudentModule through `csm` and re-mapping the key for every entry.
+        block_keys_by_module_id = {
+            student_module.id: usage_key
+            for student_module, usage_key in modules_and_keys
+        }
+
         for history_entry in history_entries:
             state = history_entry.state
 
@@ -350,10 +452,7 @@ class DjangoXBlockUserStateClient(XBlockUserStateClient):
             if state == {}:
                 state = None
 
-            block_key = history_entry.csm.module_state_key
-            block_key = block_key.map_into_course(
-                history_entry.csm.course_id
-            )
+            block_key = block_keys_by_module_id[history_entry.student_module_id]
 
             yield XBlockUserState(username, block_key, state, history_entry.created, scope)
 
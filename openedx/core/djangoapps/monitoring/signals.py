@@ -6,6 +6,7 @@ those fields will be retrieved from the model instance, and added as tags to
 the recorded metrics.
 """
 
+from collections import defaultdict
 
 from django.db.models.signals import post_save, post_delete, m2m_changed, post_init
 from django.dispatch import receiver
@@ -79,6 +80,27 @@ def post_save_metrics(sender, **kwargs):
     dog_stats_api.increment('edxapp.db.model', tags=tags)
 
 
+def bulk_create_metrics(instances, using):
+    """
+    Record the creation of models by ``bulk_create``, which doesn't send post_save,
+    in the same way that :func:`post_save_metrics` records them.
+
+    One increment is sent for each distinct set of tags, with the number of
+    instances that share those tags as its value.
+
+    Args:
+        instances (list of Model instances): The instances that were created.
+        using (str): The name of the database they were created in.
+    """
+    tag_counts = defaultdict(int)
+    for instance in instances:
+        tags = _database_tags('created', instance.__class__, {'instance': instance, 'using': using})
+        tag_counts[tuple(tags)] += 1
+
+    for tags, count in tag_counts.iteritems():
+        dog_stats_api.increment('edxapp.db.model', value=count, tags=list(tags))
+
+
 @receiver(post_delete, dispatch_uid='edxapp.monitoring.post_delete_metrics')
 def post_delete_metrics(sender, **kwargs):
     """